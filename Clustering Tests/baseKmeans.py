@@ -8,6 +8,7 @@ Code by Fred Choi
 import os
 import argparse
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from sklearn.cluster import k_means
 from sklearn.cluster import AffinityPropagation
@@ -18,7 +19,8 @@ import clusternode as cn
 
 print("Loading images...")
 filenames = glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames]
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+  images = list(executor.map(cv2.imread, filenames))
 
 def hierarchical_k_means(xs, names, k=7, split_threshold=10, max_depth=10):
   '''
@@ -139,7 +141,7 @@ cluster_id = 0 # give a unique id to each cluster
 kmeans = hierarchical_k_means(xs, np.array(filenames))
 
 f = open('./output/kmeans.json', 'w')
-f.write(kmeans.json())
+json.dump(kmeans.to_dict(), f, indent=2)
 f.write('\n')
 f.close()
 
@@ -148,7 +150,7 @@ f.close()
 # aprop = hierarchical_affinity_propagation(xs, np.array(filenames))
 
 # f = open('./output/affinity-prop.json', 'w')
-# f.write(aprop.json())
+# json.dump(aprop.to_dict(), f, indent=2)
 # f.write('\n')
 # f.close()
 
@@ -157,7 +159,7 @@ f.close()
 # mean_shift = hierarchical_mean_shift(xs, np.array(filenames))
 
 # f = open('./output/mean-shift.json', 'w')
-# f.write(mean_shift.json())
+# json.dump(mean_shift.to_dict(), f, indent=2)
 # f.write('\n')
 # f.close()
 
@@ -6,28 +6,19 @@ class ClusterNode:
     self.children = None
     self.size = size
 
-  def json(self, level=0):
-    indent = ' '*(2*level)
-    result = indent + '{\n'
+  def to_dict(self):
+    result = {}
 
     if self.name is not None:
-      result += indent + '  "name" : "' + self.name + '",\n'
+      result['name'] = self.name
 
     if self.preview is not None:
-      result += indent + '  "preview" : "' + self.preview + '",\n'
+      result['preview'] = self.preview
 
     if self.size is not None:
-      result += indent + '  "size" : ' + str(self.size) + ',\n'
+      result['size'] = int(self.size)
 
     if self.children is not None:
-      result += indent + '  "children" : [\n'
+      result['children'] = [subcluster.to_dict() for subcluster in self.children]
 
-      for subcluster in self.children:
-        result += subcluster.json(level=level + 2) + ',\n'
-      result = result[:-2] + '\n'
-      result += indent + '  ]\n,'
-
-    result = result[:-2] + '\n'
-    result += indent + '}'
-    
     return result
\ No newline at end of file
@@ -1,14 +1,21 @@
 # Test image hashing as means of clustering
 import os
+import inspect
+import json
+import argparse
 import cv2
 from glob import glob
-import imagehash
 from sklearn.cluster import KMeans, AgglomerativeClustering
-from scipy.cluster.hierarchy import linkage
-from scipy.spatial.distance import pdist, squareform
+import fastcluster
+from scipy.fft import dctn
+from numba import njit
 from sklearn.metrics.pairwise import pairwise_distances
 import numpy as np
-from PIL import Image
+from clustering_utils import cache_path, save_cache, load_images
+try:
+    import torch #Optional, only used to compute hamming distances on the GPU
+except ImportError:
+    torch = None
 
 class ClusterNode:
     def __init__(self, name=None, preview=None, size=None, x=None, y=None, bounds=None, avg_img=None):
@@ -20,40 +27,31 @@ class ClusterNode:
         self.y = y
         self.bounds = bounds
         self.avg_img = avg_img
-    # This function outputs the required json string for this cluster and any children
+    # This function outputs a json serializable dict for this cluster and any children
 
-    def json(self, level=0):
-        indent = ' '*(2*level)
-        result = indent + '{\n'
+    def to_dict(self):
+        result = {}
 
         if self.name is not None:
-            result += indent + '  "name" : "' + self.name + '",\n'
+            result['name'] = self.name
 
         if self.preview is not None:
-            result += indent + '  "preview" : "' + self.preview + '",\n'
+            result['preview'] = self.preview
 
         if self.size is not None:
-            result += indent + '  "size" : ' + str(self.size) + ',\n'
+            result['size'] = int(self.size)
 
         if self.x is not None:
-            result += indent + '  "x" : ' + str(self.x) + ',\n'
+            result['x'] = float(self.x)
 
         if self.y is not None:
-            result += indent + '  "y" : ' + str(self.y) + ',\n'
+            result['y'] = float(self.y)
 
         if self.bounds is not None:
-            result += indent + '  "bounds" : ' + str(self.bounds) + ',\n'
+            result['bounds'] = [float(b) for b in self.bounds]
 
         if self.children != []:
-            result += indent + '  "children" : [\n'
-
-            for subcluster in self.children:
-                result += subcluster.json(level=level + 2) + ',\n'
-            result = result[:-2] + '\n'
-            result += indent + '  ]\n,'
-
-        result = result[:-2] + '\n'
-        result += indent + '}'
+            result['children'] = [subcluster.to_dict() for subcluster in self.children]
 
         return result
 
@@ -79,8 +77,15 @@ def agglomerative(X, images, names, k=7, split_threshold=10, max_depth=10):
     centroid_outname = './example-data/centroids/agglomerative-mean' + str(cluster_id) + '.JPEG'
     cluster_id += 1
     cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, np.mean(images, axis=0))
+    if X.shape[0] == 1:
+        # The centroid of a single image is the image itself, so point at it instead of encoding a copy
+        cluster.preview = str(names[0])
+    else:
+        cluster.preview = centroid_outname
+        image_sum = np.zeros(images.shape[1:], np.float32)
+        for img in images:
+            cv2.accumulate(img, image_sum)
+        cv2.imwrite(centroid_outname, (image_sum / len(images)).round().astype(np.uint8))
 
     #Base Case
     if X.shape[0] < split_threshold or max_depth <= 0:
@@ -105,125 +110,186 @@ def agglomerative(X, images, names, k=7, split_threshold=10, max_depth=10):
 
     return cluster
 
+@njit(cache=True)
+def linkageAverages(hamming, images):
+    '''
+    Compute the (size weighted) average image of every merged cluster in the linkage matrix.
+    Row i merges two earlier clusters into cluster n + i, so going through the rows in
+    order is already a valid bottom up order. Clusters below n are single images and are
+    read straight from images, so only the n - 1 merged averages are stored (avgImgs[i] is cluster n + i).
+    '''
+    n = images.shape[0]
+    avgImgs = np.empty((n - 1, images.shape[1], images.shape[2], images.shape[3]), np.float32)
+    sizes = np.ones(2 * n - 1)
+    for i in range(n - 1):
+        a, b = int(hamming[i, 0]), int(hamming[i, 1])
+        if a < n:
+            imgA = images[a].astype(np.float32)
+        else:
+            imgA = avgImgs[a - n]
+        if b < n:
+            imgB = images[b].astype(np.float32)
+        else:
+            imgB = avgImgs[b - n]
+        sizes[n + i] = sizes[a] + sizes[b]
+        avgImgs[i] = (imgA * sizes[a] + imgB * sizes[b]) / sizes[n + i]
+    return avgImgs
+
 #Takes the output of hierarchical clustering based on hamming distance and turns it into clusters and average images
 def hammingClustering(hamming, images, names):
-    #Intialization
-    # print(hamming.shape)
-    n = len(hamming)
-    # print(images.shape)
-    hamming = np.asarray(hamming)
-    print(hamming[n-2])
-    completedNodes = {}
-    return createClusters(hamming[n-2], hamming, images, completedNodes, names)
-
-def createClusters(z, hamming, images, completed, names):
-    cluster = ClusterNode()
-    # print(z)
-    cluster.size = z[3] #How many nodes are under it, min is 2.
-    # cluster.x = z[2] #Distance (TODO: Add this as a seperate thing in the json for us to do stuff with)
+    '''
+    Walk the linkage matrix bottom up. Row i merges two earlier clusters into cluster n + i,
+    so both children are always finished before their parent and no recursion is needed.
+    hamming - scipy style linkage matrix over the n images
+    images - (n, h, w, 3) array of the images, used to compute the average image of each cluster
+    names - file names of the images
+    '''
+    hamming = np.asarray(hamming, dtype=np.float64)
+    n = len(images)
 
-    global cluster_id
-    #TODO If it's not a centroid, we should probably not treat it like one in the json (i.e. there should just be paths to images.)
-    centroid_outname = './example-data/centroids/hamming-average-' + str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.children = [] #Every cluster has children in this paradigm
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-
-    print(cluster_id, 'zs', z[0], z[1], z[0] in completed, z[1] in completed)
-
-    #If z is a base level image (less than n)
-    if z[0] < len(hamming) and z[1] < len(hamming):
-        #Create a centroid for these images
-        # print("Branch has reached a base node, stopping down recursion.")
-        cluster.avg_img = cv2.imwrite(centroid_outname, np.mean((images[int(z[0])], images[int(z[1])]), axis=0))
-        completed[z[0]] = images[int(z[0])]
-        completed[z[1]] = images[int(z[1])]
-        print(cluster_id, 'Finished')
-        cluster.children = [
-            ClusterNode(os.path.basename(names[int(z[0])]), names[int(z[0])], 1),
-            ClusterNode(os.path.basename(names[int(z[1])]), names[int(z[1])], 1)
-        ]
-        return cluster
-    #General case, requiring some level of recursion to unpack a cluster.
-    #NOTE: It'd be better design if this was a function.
-    #if it's been completed, we need it's average image
-    if z[0] in completed:
-        img1 = completed[z[0]]
-    #if it's never been touched, but big enough, we need to recurse and complete it.
-    elif z[0] > len(hamming):
-        child = int(z[0]) - len(hamming)
-        completed[z[0]] = True
-        newCluster1 = createClusters(hamming[child], hamming, images, completed, names)
-        cluster.children.append(newCluster1)
-        img1 = newCluster1.avg_img #NOTE: This whole average image storage in the object is useless now
-        completed[z[0]] = img1
-    #if it's never been touched, but small enough, we can complete it.
-    else:
-        img1 = images[int(z[0])]
-        completed[z[0]] = img1
-        #TODO: Shouldn't make an extra cluster for one of these
-    #if it's been completed, we need it's average image
-    if z[1] in completed:
-        img2 = completed[z[1]]
-    #if it's never been touched, but big enough, we need to recurse and complete it.
-    elif z[1] > len(hamming):
-        child = int(z[1]) - len(hamming)
-        completed[z[1]] = True
-        newCluster2 = createClusters(hamming[child], hamming, images, completed, names)
-        cluster.children.append(newCluster2)
-        img2 = newCluster2.avg_img
-        completed[z[1]] = img2
-    #if it's never been touched, but small enough, we can complete it.
-    else:
-        img2 = images[int(z[0])]
-        completed[z[1]] = img2
+    #Average image of every cluster, computed in compiled code
+    avgImgs = linkageAverages(hamming, np.asarray(images))
 
-    #Create an avg image using the prior averages TODO: See if this can be weighted by cluster size.
-    cluster.avg_img = cv2.imwrite(centroid_outname, np.mean([img1, img2], axis=0))
-    return cluster
+    #Build the tree, again bottom up, writing out each cluster's average image
+    global cluster_id
+    nodes = [ClusterNode(os.path.basename(name), name, 1) for name in names] + [None] * (n - 1)
+    for i, z in enumerate(hamming):
+        a, b = int(z[0]), int(z[1])
+        centroid_outname = './example-data/centroids/hamming-average-' + str(cluster_id) + '.JPEG'
+        cluster_id += 1
+        cluster = ClusterNode(f'cluster {cluster_id}', centroid_outname, int(z[3]))
+        cluster.children = [nodes[a], nodes[b]]
+        cv2.imwrite(centroid_outname, avgImgs[i].round().astype(np.uint8))
+        nodes[n + i] = cluster
+
+    return nodes[-1]
 
 def linalgNorm(x, y):
     return np.linalg.norm(x-y)
 
+def prepareHashInput(images):
+    #Shrink every image to 32x32 greyscale once, all of the hashes below start from this
+    return np.stack([cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA) for img in images]).astype(np.float32)
+
+def averageHash(prep):
+    #aHash for the whole batch at once: average 4x4 blocks down to 8x8, then compare each pixel to its image's mean
+    small = prep.reshape(len(prep), 8, 4, 8, 4).mean(axis=(2, 4)).reshape(len(prep), 64)
+    return (small > small.mean(axis=1, keepdims=True)).astype(np.uint8)
+
+def differenceHash(prep):
+    #dHash: shrink to 9x8, then compare each pixel to its right neighbour
+    small = np.stack([cv2.resize(p, (9, 8), interpolation=cv2.INTER_AREA) for p in prep])
+    return (small[:, :, 1:] > small[:, :, :-1]).reshape(len(prep), 64).astype(np.uint8)
+
+def pHash(prep):
+    #pHash: keep the lowest 8x8 DCT frequencies, then compare each to its image's median
+    low = dctn(prep, axes=(1, 2))[:, :8, :8].reshape(len(prep), 64)
+    return (low > np.median(low, axis=1, keepdims=True)).astype(np.uint8)
+
+# Each hash function takes the output of prepareHashInput and produces 64 bits per image
+hashers = {
+    'average': averageHash,
+    'difference': differenceHash,
+    'phash': pHash,
+}
+
+def hashImages(prep, method='phash'):
+    #Returns an (N, 64) matrix of hash bits, ready for hamming distances
+    return hashers[method](prep)
+
+if hasattr(np, 'bitwise_count'): #NumPy >= 2.0
+    popcount = np.bitwise_count
+else:
+    def popcount(x):
+        return np.unpackbits(x.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+def popcountSwar(x):
+    #SWAR popcount of int64 tensors, torch has no popcount of its own
+    x = x - ((x >> 1) & 0x5555555555555555)
+    x = (x & 0x3333333333333333) + ((x >> 2) & 0x3333333333333333)
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0F
+    return (x * 0x0101010101010101) >> 56
+
+def hammingPdistGpu(bits, block=256):
+    '''
+    hammingPdist on the GPU. Rows are handled a block at a time, each against all later rows.
+    The upper triangle of each block is cut out on the device and copied back as uint8
+    (counts never exceed 64), already in condensed order.
+    '''
+    n = bits.shape[0]
+    packed = torch.from_numpy(np.packbits(bits, axis=1).view(np.int64).ravel()).cuda()
+    dist = np.empty(n * (n - 1) // 2)
+    start = 0
+    for i in range(0, n, block):
+        counts = popcountSwar(packed[i:i+block, None] ^ packed[None, i:]).to(torch.uint8)
+        upper = torch.ones(counts.shape, dtype=torch.bool, device=counts.device).triu(1)
+        counts = counts[upper].cpu().numpy()
+        dist[start:start+len(counts)] = counts
+        start += len(counts)
+    return dist / bits.shape[1]
+
+def hammingPdist(bits, gpuThreshold=10000):
+    '''
+    Same result as pdist(bits, metric='hamming'), but each 64 bit hash is packed into
+    a single uint64 and compared with xor + popcount instead of bit by bit.
+    Large inputs are sent to the GPU when torch with CUDA is available.
+    '''
+    n = bits.shape[0]
+    if n >= gpuThreshold and torch is not None and torch.cuda.is_available():
+        return hammingPdistGpu(bits)
+    packed = np.packbits(bits, axis=1).view(np.uint64).ravel()
+    dist = np.empty(n * (n - 1) // 2)
+    start = 0
+    for i in range(n - 1):
+        end = start + n - 1 - i
+        dist[start:end] = popcount(packed[i] ^ packed[i+1:])
+        start = end
+    return dist / bits.shape[1]
+
+parser = argparse.ArgumentParser(description='Cluster the example images by pixel distance and, optionally, by image hash.')
+parser.add_argument('--hamming', action='store_true', help='also run the hamming linkage over the image hashes (rewrites hamming.txt, example-data/hamming-hashed.json and the hamming-average centroids)')
+args = parser.parse_args()
+
 # Prepare input data
 print("Initializing images...")
 filenames = glob('./example-data/images/*.JPEG') #Grab all the image files
-images = [cv2.imread(fname) for fname in filenames] #Load all images
-rawimages = [Image.open(fname) for fname in filenames] #Load all raw images to be hashed NOTE this probably doesn't scale well
-
-
-#Hash all images
-X_hashed = [imagehash.phash(x).hash for x in rawimages]
-# print(X_averagehashed)
-X_hashed = np.stack(X_hashed).reshape(len(images), -1)
+images = load_images(filenames) #Load all images
+
+#Hash all images, or reuse the hashes of an earlier run over the same files
+hashMethod = 'phash'
+#The hashing code is part of the key, so editing a hash function doesn't reuse hashes computed by the old one
+hashPath = cache_path('./.cache', 'hashes-' + hashMethod, filenames, inspect.getsource(prepareHashInput), inspect.getsource(hashers[hashMethod]))
+if os.path.exists(hashPath):
+    X_hashed = np.load(hashPath)
+else:
+    hashInput = prepareHashInput(images)
+    X_hashed = hashImages(hashInput, method=hashMethod)
+    save_cache(hashPath, X_hashed)
 
 # print(X_hashed)
 print("Computing Agglomerative...") #Agglomerative clustering works fine, but image hashing ignores color, might need to try a new metric.
-hammingDistMatrix = pdist(X_hashed, metric='hamming')
-hammingDist = squareform(hammingDistMatrix)
-# print(hammingDist)
-Img = np.stack(images).reshape(len(images),-1)
+Img = images.reshape(len(images),-1)
 # print(linalgNorm(images[0], images[1]))
 normDist = pairwise_distances(Img, Img, metric=linalgNorm) #Maybe cache this, it takes forever to compute
 # print(normDist)
-agglo = agglomerative(normDist, np.stack(images), np.array(filenames), k=10, max_depth=20)
+agglo = agglomerative(normDist, images, np.array(filenames), k=10, max_depth=20)
 
 f = open('./example-data/agglo.json', 'w')
-f.write(agglo.json())
+json.dump(agglo.to_dict(), f, indent=2)
 f.write('\n')
 f.close()
 
-# print("Computing Hamming Linkage...")
-# cluster_id = 0
-# X_avg = pdist(X_avg, metric='hamming')
-# hamming = linkage(X_avg, metric='hamming', method='complete')
-# np.savetxt('hamming.txt', hamming)
-# ham = hammingClustering(hamming, np.stack(images), np.array(filenames))
-
-# f = open('./example-data/hamming-hashed.json', 'w')
-# f.write(ham.json())
-# f.write('\n')
-# f.close()
+if args.hamming: #Off by default, it writes one centroid per merge (n - 1 of them)
+    print("Computing Hamming Linkage...")
+    cluster_id = 0
+    hammingDistMatrix = hammingPdist(X_hashed) #Condensed, linkage works on this directly so no square matrix is needed
+    hamming = fastcluster.linkage(hammingDistMatrix, method='complete')
+    np.savetxt('hamming.txt', hamming)
+    ham = hammingClustering(hamming, images, np.array(filenames))
+
+    f = open('./example-data/hamming-hashed.json', 'w')
+    json.dump(ham.to_dict(), f, indent=2)
+    f.write('\n')
+    f.close()
 
 print("Done!")
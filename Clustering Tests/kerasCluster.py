@@ -2,94 +2,104 @@ from keras.preprocessing import image
 from keras.applications.vgg16 import VGG16
 from keras.applications.vgg16 import preprocess_input
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
 import glob
 from clusternode import ClusterNode
-import cv2
+from clustering_utils import cache_path, save_cache, load_images, compute_subclusters, sum_leaf_cluster, write_centroid, number_clusters
 import os
+from concurrent.futures import ThreadPoolExecutor
+import json
 import argparse
 
-def hierarchical_k_means(X, images, names,  k=7, split_threshold=10, max_depth=10):
+def hierarchical_k_means(X, images, indices, names, prefix, k=7, split_threshold=10, max_depth=10, n_init=3, n_jobs=-1):
     '''
     Compute the hierarchical k means of a (transformed) data set.
     X - input data
+    images - all of the images, shared by every level of the recursion
+    indices - which of the images are in this cluster
     names - labels (to keep track of whats in which cluster)
     locations - locations of data poitns in a particular embedding
     k - branching factor. How many clusters per level.
     split_threshold and max_depth - stopping point for recursion
+    n_init - k means restarts at every split
+    prefix - where to write the centroid images, prefix + id + '.JPEG'
+    n_jobs - how many of the subclusters to compute in parallel
     '''
     cluster = ClusterNode()
     cluster.size = X.shape[0]
 
-    # output the centroids to a separate file
-    global cluster_id
-    centroid_outname = './output/centroids/keras-centroid-' + \
-        str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, np.mean(images, axis=0))
-
     # Base Case
     if X.shape[0] < split_threshold or max_depth <= 0:
         cluster.children = [ClusterNode(os.path.basename(
             name), name, 1) for name in names]
-        return cluster
+        return sum_leaf_cluster(cluster, images, indices, names, prefix)
 
     # Cluster and Recurse
-    kmeans = KMeans(n_clusters=k).fit(X)
+    kmeans = MiniBatchKMeans(n_clusters=k, batch_size=256, n_init=n_init).fit(X)
     labels = kmeans.labels_
+    # Each subcluster writes its own centroids in whichever worker computes it
+    results = compute_subclusters(hierarchical_k_means, labels, max_depth, n_jobs,
+        dict(X=X, indices=indices, names=names),
+        images=images, prefix=prefix, k=k, split_threshold=split_threshold, n_init=n_init)
 
     cluster.children = []
-    for i in range(k):
-        cluster_X = X[labels == i]
-        cluster_images = images[labels == i]
-        cluster_names = names[labels == i]
-        subcluster = hierarchical_k_means(cluster_X, cluster_images, cluster_names,
-                                          k=k, split_threshold=split_threshold, max_depth=max_depth-1)
+    image_sum = np.zeros(images.shape[1:], np.float32)
+    for subcluster, subcluster_sum, _ in results:
+        image_sum += subcluster_sum
         cluster.children.append(subcluster)
 
-    return cluster
+    write_centroid(cluster, image_sum, prefix)
+    return cluster, image_sum, cluster.size
+
+def loadKerasInput(img_path):
+    # Code to take an image and turn it into a model input
+    img = image.load_img(img_path) #All images already the same size
+    img_data = image.img_to_array(img)
+    img_data = np.expand_dims(img_data, axis=0)
+    return preprocess_input(img_data)
+
+def kerasCluster(filenames, cache_dir='./.cache'):
+    # The features only depend on the input files, so cache them keyed by the files
+    features_path = cache_path(cache_dir, 'vgg16', filenames)
+    if os.path.exists(features_path):
+        print("Loading cached features from " + features_path)
+        return np.load(features_path)
 
-def kerasCluster(filenames):
     model = VGG16(weights='imagenet', include_top=False)
     model.summary()
     # Idea: Use glob and the file names to implment this. I think it's kind of cheating given our goal w the project but it should work fine overall
 
     # Use silhouette coefficient to validate https://scikit-learn.org/stable/modules/clustering.html#silhouette-coefficient
 
-    vgg16_feature_list = []
+    # Decode and preprocess in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        inputs = list(executor.map(loadKerasInput, filenames))
 
-    # images = [cv2.imread(fname) for fname in filenames]
-    # print(filenames)
-    for img_path in filenames:
-        # print(img_path)
-        # Code to take an image and add it to the model feature list
-        img = image.load_img(img_path) #All images already the same size
-        img_data = image.img_to_array(img)
-        img_data = np.expand_dims(img_data, axis=0)
-        img_data = preprocess_input(img_data)
+    # Run the model over all images in batches instead of one predict call per image
+    vgg16_features = model.predict(np.concatenate(inputs), batch_size=32)
 
-        vgg16_feature = model.predict(img_data)
-        vgg16_feature_np = np.array(vgg16_feature)
-        vgg16_feature_list.append(vgg16_feature_np.flatten())
-
-    # Take the feature list, make it into a numpy array, and then fit a k means model to it.
-    vgg16_feature_list_np = np.array(vgg16_feature_list)
+    # Flatten the features of each image into one row, ready to fit a k means model to.
+    vgg16_feature_list_np = vgg16_features.reshape(len(filenames), -1)
     print(vgg16_feature_list_np)
+
+    save_cache(features_path, vgg16_feature_list_np)
     return vgg16_feature_list_np
 
 filenames = glob.glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames] #Load all images
+images = load_images(filenames) #Load all images
 
 print("Clustering (K-Means) + Keras...")
-cluster_id = 0 # give a unique id to each cluster
-kerasPreproc = kerasCluster(filenames) #TODO Cache this result
+kerasPreproc = kerasCluster(filenames)
+# Compress the (very wide) VGG16 features before clustering, small sets can't have more components than images
+kerasPreproc = PCA(n_components=min(64, *kerasPreproc.shape)).fit_transform(kerasPreproc).astype(np.float32)
 print("Keras Model Completed Training")
-kmeans = hierarchical_k_means(kerasPreproc, np.stack(images), np.array(filenames))
+centroid_prefix = './output/centroids/keras-centroid-'
+kmeans, _, _ = hierarchical_k_means(kerasPreproc, images, np.arange(len(images)), np.array(filenames), centroid_prefix)
+number_clusters(kmeans, centroid_prefix)
 
 f = open('./output/keras.json', 'w')
-f.write(kmeans.json())
+json.dump(kmeans.to_dict(), f, indent=2)
 f.write('\n')
 f.close()
 print("Completed!")
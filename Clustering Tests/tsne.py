@@ -1,11 +1,12 @@
 import os
-import cv2
+import json
 from glob import glob
 import numpy as np
-from sklearn.manifold import TSNE
+from openTSNE import TSNE
 from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 import matplotlib.pyplot as plt
+from clustering_utils import load_images, compute_subclusters, sum_leaf_cluster, write_centroid, number_clusters
 
 
 # Used to store the clusters and output them JSON
@@ -18,106 +19,92 @@ class ClusterNode:
         self.x = x
         self.y = y
         self.bounds = bounds
-    #This function outputs the required json string for this cluster and any children
-    def json(self, level=0):
-        indent = ' '*(2*level)
-        result = indent + '{\n'
+    #This function outputs a json serializable dict for this cluster and any children
+    def to_dict(self):
+        result = {}
 
         if self.name is not None:
-            result += indent + '  "name" : "' + self.name + '",\n'
+            result['name'] = self.name
 
         if self.preview is not None:
-            result += indent + '  "preview" : "' + self.preview + '",\n'
+            result['preview'] = self.preview
 
         if self.size is not None:
-            result += indent + '  "size" : ' + str(self.size) + ',\n'
+            result['size'] = int(self.size)
 
         if self.x is not None:
-            result += indent + ' "x" : ' + str(self.x) + ',\n'
+            result['x'] = float(self.x)
 
         if self.y is not None:
-            result += indent + ' "y" : ' + str(self.y) + ',\n'
+            result['y'] = float(self.y)
 
         if self.bounds is not None:
-            result += indent + '  "bounds" : ' + str(self.bounds) + ',\n'
+            result['bounds'] = [float(b) for b in self.bounds]
 
         if self.children != []:
-            result += indent + '  "children" : [\n'
-
-            for subcluster in self.children:
-                result += subcluster.json(level=level + 2) + ',\n'
-            result = result[:-2] + '\n'
-            result += indent + '  ]\n,'
-
-        result = result[:-2] + '\n'
-        result += indent + '}'
+            result['children'] = [subcluster.to_dict() for subcluster in self.children]
 
         return result
 
 
-cluster_id = 0
 
 
-def hierarchical_k_means(X, images, names, locations, k=7, split_threshold=10, max_depth=10):
+def hierarchical_k_means(X, images, indices, names, locations, prefix, k=7, split_threshold=10, max_depth=10, n_init=3, n_jobs=-1):
     '''
     Compute the hierarchical k means of a (transformed) data set.
     X - input data
+    images - all of the images, shared by every level of the recursion
+    indices - which of the images are in this cluster
     names - labels (to keep track of whats in which cluster)
     locations - locations of data poitns in a particular embedding
     k - branching factor. How many clusters per level.
     split_threshold and max_depth - stopping point for recursion
+    n_init - k means restarts at every split
+    prefix - where to write the centroid images, prefix + id + '.JPEG'
+    n_jobs - how many of the subclusters to compute in parallel
     '''
     cluster = ClusterNode()
     cluster.size = X.shape[0]
     cluster.bounds = [np.min(locations[:, 0]), np.min(
         locations[:, 1]), np.ptp(locations[:, 0]), np.ptp(locations[:, 1])]
 
-    # output the centroids to a separate file
-    global cluster_id
-    centroid_outname = './output/centroids/kmeans-centroid-' + \
-        str(cluster_id) + '.JPEG'
-    cluster_id += 1
-    cluster.name = f'cluster {cluster_id}'
-    cluster.preview = centroid_outname
-    cv2.imwrite(centroid_outname, np.mean(images, axis=0))
-
     # Base Case
     if X.shape[0] < split_threshold or max_depth <= 0:
         cluster.children = [ClusterNode(os.path.basename(
             name), name, 1, x=location[0], y=location[1]) for name, location in zip(names, locations)]
-        return cluster
+        return sum_leaf_cluster(cluster, images, indices, names, prefix)
 
     # Cluster and Recurse
-    kmeans = KMeans(n_clusters=k).fit(X)
+    kmeans = MiniBatchKMeans(n_clusters=k, batch_size=256, n_init=n_init).fit(X)
     labels = kmeans.labels_
+    # Each subcluster writes its own centroids in whichever worker computes it
+    results = compute_subclusters(hierarchical_k_means, labels, max_depth, n_jobs,
+        dict(X=X, indices=indices, names=names, locations=locations),
+        images=images, prefix=prefix, k=k, split_threshold=split_threshold, n_init=n_init)
 
     cluster.children = []
-    for i in range(k):
-        cluster_X = X[labels == i]
-        cluster_images = images[labels == i]
-        cluster_names = names[labels == i]
-        cluster_locations = locations[labels == i]
-        subcluster = hierarchical_k_means(cluster_X, cluster_images, cluster_names,
-                                          cluster_locations, k=k, split_threshold=split_threshold, max_depth=max_depth-1)
-
+    image_sum = np.zeros(images.shape[1:], np.float32)
+    for subcluster, subcluster_sum, _ in results:
+        image_sum += subcluster_sum
         cluster.children.append(subcluster)
 
-    return cluster
+    write_centroid(cluster, image_sum, prefix)
+    return cluster, image_sum, cluster.size
 
 
 # Prepare input data
 print("Initializing images...")
 filenames = glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames]
-image_shape = images[0].shape
-X = np.stack(images).reshape(len(images), -1)
+images = load_images(filenames)
+image_shape = images.shape[1:]
+X = images.reshape(len(images), -1)
 
 # Reduce dimensionality
 print("Performing PCA...")
 X_reduced = PCA(n_components=20).fit_transform(X)
 
 print("Trying TSNE...")
-X_embedded = TSNE(n_components=2).fit_transform(X_reduced)
+X_embedded = np.asarray(TSNE(n_components=2, n_jobs=-1, negative_gradient_method='fft').fit(X_reduced))
 
 # plt.scatter(X_embedded[:, 0], X_embedded[:, 1])
 # plt.show()
@@ -131,11 +118,13 @@ X_embedded = TSNE(n_components=2).fit_transform(X_reduced)
 
 print("Computing K-means...")
 
-hkmeans = hierarchical_k_means(X_reduced, np.stack(
-    images), np.array(filenames), X_embedded)
+centroid_prefix = './output/centroids/kmeans-centroid-'
+hkmeans, _, _ = hierarchical_k_means(X_reduced, images, np.arange(
+    len(images)), np.array(filenames), X_embedded, centroid_prefix)
+number_clusters(hkmeans, centroid_prefix)
 
 f = open('./output/kmeans-tsne.json', 'w')
-f.write(hkmeans.json())
+json.dump(hkmeans.to_dict(), f, indent=2)
 f.write('\n')
 f.close()
 
@@ -0,0 +1,133 @@
+'''
+Helpers shared by the clustering scripts: the on-disk cache of decoded images and
+features, and the pieces of the parallel hierarchical k means.
+offline-clustering is run on its own, so it keeps a copy of this file next to tsne-keras.py.
+'''
+
+import os
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob, escape as glob_escape
+import cv2
+import numpy as np
+from joblib import Parallel, delayed
+
+# On-disk cache
+def cache_path(cache_dir, kind, filenames, *params):
+    '''
+    Path of the cache entry of this kind for filenames. params (e.g. the settings the entry was
+    computed with) are part of the key, so changing them misses the cache instead of reusing it.
+    Entries for files in different folders are kept apart, so switching datasets keeps both caches.
+    '''
+    folders = sorted({os.path.dirname(os.path.abspath(fname)) for fname in filenames})
+    slot = hashlib.md5(repr(folders).encode()).hexdigest()[:8]
+    # Changes whenever an image is added, removed, reordered or modified, or params change
+    key = hashlib.md5(repr(([(fname, os.path.getmtime(fname)) for fname in filenames], params)).encode()).hexdigest()
+    return os.path.join(cache_dir, kind + '-' + slot + '-' + key + '.npy')
+
+def clear_stale(path):
+    # Remove the entry that path replaces: same kind and folders, but computed from older files or settings
+    stem = glob_escape(path[:path.rindex('-') + 1])
+    for old_path in glob(stem + '*.npy') + glob(stem + '*.npy.partial'):
+        if old_path != path:
+            os.remove(old_path)
+
+def save_cache(path, array):
+    # Write next to path and rename, so an interrupted run never leaves a broken cache behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = path + '.partial'
+    with open(partial_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(partial_path, path)
+    clear_stale(path)
+
+def load_images(filenames, cache_dir='./.cache'):
+    '''
+    Decode all images (which are all the same size) into one contiguous uint8 array, memory mapped
+    from a .npy file in cache_dir. Later runs over the same files just map the cached file again.
+    '''
+    path = cache_path(cache_dir, 'images', filenames)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial_path = path + '.partial'
+    shape = (len(filenames),) + cv2.imread(filenames[0]).shape
+    images = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.uint8, shape=shape)
+
+    def load(i):
+        images[i] = cv2.imread(filenames[i])
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor: #cv2 releases the GIL while decoding
+        list(executor.map(load, range(len(filenames))))
+    images.flush()
+    images = None # close the writable map before the rename
+    os.replace(partial_path, path)
+    clear_stale(path)
+    return np.load(path, mmap_mode='r')
+
+# Hierarchical k means
+def compute_subclusters(recurse, labels, max_depth, n_jobs, sliced, **shared):
+    '''
+    Call recurse once per non-empty label of a k means split, with the rows of every array in sliced
+    that have that label, and pass shared through unchanged.
+    The subclusters don't depend on each other, so they are computed in parallel.
+    Inside the workers everything runs serially to avoid oversubscribing the cores.
+    '''
+    masks = [labels == i for i in np.unique(labels)] # MiniBatchKMeans can leave a centre without any points
+    return Parallel(n_jobs=n_jobs)(delayed(recurse)(
+        **{key: value[mask] for key, value in sliced.items()}, **shared,
+        max_depth=max_depth-1, n_jobs=1) for mask in masks)
+
+def sum_leaf_cluster(cluster, images, indices, names, prefix):
+    '''
+    Sum the images of a cluster that is not split any further and write its centroid.
+    Returns the cluster together with the sum and count of its images, so that parents
+    can compute their centroid from their children's sums instead of re-averaging every image.
+    '''
+    if cluster.size == 1:
+        # The centroid of a single image is the image itself, so point at it instead of encoding a copy
+        cluster.preview = str(names[0])
+        image_sum = images[indices[0]].astype(np.float32)
+    else:
+        # Accumulate in float32 (SIMD in OpenCV) rather than promoting the whole uint8 stack to float64
+        image_sum = np.zeros(images.shape[1:], np.float32)
+        for index in indices:
+            cv2.accumulate(images[index], image_sum)
+    write_centroid(cluster, image_sum, prefix)
+    return cluster, image_sum, cluster.size
+
+def write_centroid(cluster, image_sum, prefix):
+    '''
+    Write the average image of the cluster to a temporary file next to the other centroids.
+    This runs in whichever worker built the cluster, so the image never has to leave it.
+    number_clusters gives it its final name once the whole tree is known.
+    '''
+    if cluster.preview is None: # singleton clusters already preview their only image
+        cluster.preview = prefix + 'tmp-' + uuid.uuid4().hex + '.JPEG'
+        cv2.imwrite(cluster.preview, (image_sum / cluster.size).round().astype(np.uint8))
+
+def number_clusters(cluster, prefix):
+    '''
+    Number the clusters in preorder, name them 'cluster <id + 1>' and move their centroids from
+    write_centroid to prefix + id + '.JPEG'. Centroids left over from earlier runs are removed first.
+    '''
+    for old_centroid in glob(glob_escape(prefix) + '[0-9]*.JPEG'):
+        os.remove(old_centroid)
+    cluster_id = 0
+    stack = [cluster]
+    while stack:
+        node = stack.pop()
+        if not node.children: # a single image, not a cluster
+            continue
+        node.name = f'cluster {cluster_id + 1}'
+        if node.preview.startswith(prefix + 'tmp-'):
+            centroid_outname = prefix + str(cluster_id) + '.JPEG'
+            os.replace(node.preview, centroid_outname)
+            node.preview = centroid_outname
+        cluster_id += 1
+        stack.extend(reversed(node.children))
+    # Temporary centroids of interrupted runs
+    for old_centroid in glob(glob_escape(prefix) + 'tmp-*.JPEG'):
+        os.remove(old_centroid)
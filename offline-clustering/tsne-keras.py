@@ -1,14 +1,16 @@
 import os
-import cv2
+import json
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import numpy as np
-from sklearn.manifold import TSNE
+from openTSNE import TSNE
 from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 import matplotlib.pyplot as plt
 from keras.preprocessing import image
 from keras.applications.vgg16 import VGG16
 from keras.applications.vgg16 import preprocess_input
+from clustering_utils import cache_path, save_cache, load_images, compute_subclusters, sum_leaf_cluster, write_centroid, number_clusters
 
 
 # Used to store the clusters and output them JSON
@@ -21,135 +23,132 @@ class ClusterNode:
     self.x = x
     self.y = y
 
-  def json(self, level=0):
-    indent = ' '*(2*level)
-    result = indent + '{\n'
+  def to_dict(self):
+    result = {}
 
     if self.name is not None:
-      result += indent + '  "name" : "' + self.name + '",\n'
+      result['name'] = self.name
 
     if self.preview is not None:
-      result += indent + '  "preview" : "' + self.preview + '",\n'
+      result['preview'] = self.preview
 
     if self.size is not None:
-      result += indent + '  "size" : ' + str(self.size) + ',\n'
+      result['size'] = int(self.size)
 
     if self.x is not None:
-      result += indent + '  "x" : ' + str(list(self.x)) + ',\n'
+      result['x'] = float(self.x)
 
     if self.y is not None:
-      result += indent + '  "y" : ' + str(list(self.y)) + ',\n'
+      result['y'] = float(self.y)
 
     if self.children != []:
-      result += indent + '  "children" : [\n'
+      result['children'] = [subcluster.to_dict() for subcluster in self.children]
 
-      for subcluster in self.children:
-        result += subcluster.json(level=level + 2) + ',\n'
-      result = result[:-2] + '\n'
-      result += indent + '  ]\n,'
-
-    result = result[:-2] + '\n'
-    result += indent + '}'
-    
     return result
 
-cluster_id = 0
-def hierarchical_k_means(X, images, names, locations, k=7, split_threshold=10, max_depth=10):
+def hierarchical_k_means(X, images, indices, names, embedding, prefix, k=7, split_threshold=10, max_depth=10, n_init=3, n_jobs=-1):
   '''
   Compute the hierarchical k means of a (transformed) data set.
 
   X - input data
+  images - all of the images, shared by every level of the recursion
+  indices - which of the images are in this cluster
   names - labels (to keep track of whats in which cluster)
-  locations - locations of data poitns in a particular embedding
+  embedding - locations of the data points in the t-SNE embedding computed once over the whole data set
   k - branching factor. How many clusters per level.
   split_threshold and max_depth - stopping point for recursion
+  n_init - k means restarts at every split
+  prefix - where to write the centroid images, prefix + id + '.JPEG'
+  n_jobs - how many of the subclusters to compute in parallel
   '''
   cluster = ClusterNode()
   cluster.size = X.shape[0]
-  cluster.x = np.mean(locations[:, 0, :], axis=0)
-  cluster.y = np.mean(locations[:, 1, :], axis=0)
-
-  # output the centroids to a separate file
-  global cluster_id
-  centroid_outname = './example-data/centroids/keras-centroid-' + str(cluster_id) + '.JPEG'
-  cluster_id += 1
-  cluster.name = f'cluster {cluster_id}'
-  cluster.preview = centroid_outname
-  cv2.imwrite(centroid_outname, np.mean(images, axis=0))
-
-  # Compute locations
-  if cluster.size > 1:
-    X_embedded = TSNE(n_components=2).fit_transform(X)
-  else:
-    X_embedded = np.zeros((1, 2))
-  locations = np.concatenate([locations, X_embedded[:, :, None]], axis=2)
+  # Every level shares the one embedding, so each node stores a single location
+  cluster.x = np.mean(embedding[:, 0])
+  cluster.y = np.mean(embedding[:, 1])
 
   # Base Case
   if X.shape[0] < split_threshold or max_depth <= 0:
-    cluster.children = [ClusterNode(os.path.basename(name), name, 1, x=location[0], y=location[1]) for name, location in zip(names, locations)]
-    return cluster
+    cluster.children = [ClusterNode(os.path.basename(name), name, 1, x=location[0], y=location[1]) for name, location in zip(names, embedding)]
+    return sum_leaf_cluster(cluster, images, indices, names, prefix)
 
   # Cluster and Recurse
-  kmeans = KMeans(n_clusters=k).fit(X)
+  kmeans = MiniBatchKMeans(n_clusters=k, batch_size=256, n_init=n_init).fit(X)
   labels = kmeans.labels_
+  # Each subcluster writes its own centroids in whichever worker computes it
+  results = compute_subclusters(hierarchical_k_means, labels, max_depth, n_jobs,
+    dict(X=X, indices=indices, names=names, embedding=embedding),
+    images=images, prefix=prefix, k=k, split_threshold=split_threshold, n_init=n_init)
 
   cluster.children = []
-  for i in range(k):
-    cluster_X = X[labels==i]
-    cluster_images = images[labels==i]
-    cluster_names = names[labels==i]
-    cluster_locations = locations[labels==i]
-    subcluster = hierarchical_k_means(cluster_X, cluster_images, cluster_names, cluster_locations, k=k, split_threshold=split_threshold, max_depth=max_depth-1)
-
+  image_sum = np.zeros(images.shape[1:], np.float32)
+  for subcluster, subcluster_sum, _ in results:
+    image_sum += subcluster_sum
     cluster.children.append(subcluster)
 
-  return cluster
+  write_centroid(cluster, image_sum, prefix)
+  return cluster, image_sum, cluster.size
+
+def loadKerasInput(img_path):
+    # Code to take an image and turn it into a model input
+    img = image.load_img(img_path) #All images already the same size
+    img_data = image.img_to_array(img)
+    img_data = np.expand_dims(img_data, axis=0)
+    return preprocess_input(img_data)
+
+def kerasCluster(filenames, cache_dir='./.cache'):
+    # The features only depend on the input files, so cache them keyed by the files
+    features_path = cache_path(cache_dir, 'vgg16', filenames)
+    if os.path.exists(features_path):
+        print("Loading cached features from " + features_path)
+        return np.load(features_path)
 
-def kerasCluster(filenames):
     model = VGG16(weights='imagenet', include_top=False)
     model.summary()
     # Idea: Use glob and the file names to implment this. I think it's kind of cheating given our goal w the project but it should work fine overall
 
     # Use silhouette coefficient to validate https://scikit-learn.org/stable/modules/clustering.html#silhouette-coefficient
 
-    vgg16_feature_list = []
+    # Decode and preprocess in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        inputs = list(executor.map(loadKerasInput, filenames))
 
-    # images = [cv2.imread(fname) for fname in filenames]
-    # print(filenames)
-    for img_path in filenames:
-        # print(img_path)
-        # Code to take an image and add it to the model feature list
-        img = image.load_img(img_path) #All images already the same size
-        img_data = image.img_to_array(img)
-        img_data = np.expand_dims(img_data, axis=0)
-        img_data = preprocess_input(img_data)
+    # Run the model over all images in batches instead of one predict call per image
+    vgg16_features = model.predict(np.concatenate(inputs), batch_size=32)
 
-        vgg16_feature = model.predict(img_data)
-        vgg16_feature_np = np.array(vgg16_feature)
-        vgg16_feature_list.append(vgg16_feature_np.flatten())
-
-    # Take the feature list, make it into a numpy array, and then fit a k means model to it.
-    vgg16_feature_list_np = np.array(vgg16_feature_list)
+    # Flatten the features of each image into one row, ready to fit a k means model to.
+    vgg16_feature_list_np = vgg16_features.reshape(len(filenames), -1)
     print(vgg16_feature_list_np)
+
+    save_cache(features_path, vgg16_feature_list_np)
     return vgg16_feature_list_np
 
 # Prepare input data
 print("Initializing images...")
 filenames = glob('./example-data/images/*.JPEG')
-images = [cv2.imread(fname) for fname in filenames]
-image_shape = images[0].shape
-X = np.stack(images).reshape(len(images), -1)  
+images = load_images(filenames)
+image_shape = images.shape[1:]
+X = images.reshape(len(images), -1)
 
 # Transform using keras
 print("Transforming with keras")
-X_transformed = kerasCluster(filenames) #TODO Cache this result
+X_transformed = kerasCluster(filenames)
+
+# Compress the (very wide) VGG16 features before t-SNE and k means, small sets can't have more components than images
+print("Performing PCA...")
+X_transformed = PCA(n_components=min(64, *X_transformed.shape)).fit_transform(X_transformed).astype(np.float32)
+
+print("Computing TSNE...")
+X_embedded = np.asarray(TSNE(n_components=2, n_jobs=-1, negative_gradient_method='fft').fit(X_transformed))
 
 print("Computing K-means...")
 
-hkmeans = hierarchical_k_means(X_transformed, np.stack(images), np.array(filenames), np.zeros((len(images), 2, 0)))
+centroid_prefix = './example-data/centroids/keras-centroid-'
+hkmeans, _, _ = hierarchical_k_means(X_transformed, images, np.arange(len(images)), np.array(filenames), X_embedded, centroid_prefix)
+number_clusters(hkmeans, centroid_prefix)
 
 f = open('./example-data/keras-data.json', 'w')
-f.write(hkmeans.json())
+json.dump(hkmeans.to_dict(), f, indent=2)
 f.write('\n')
 f.close()
 
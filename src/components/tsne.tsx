@@ -142,9 +142,19 @@ function colorIndex<T>(node: d3.HierarchyNode<T>): number {
 
 type Node = d3.HierarchyNode<ClusterData>;
 
+/**
+ * Coordinate of a node when the tree is shown at the given depth. Data from a
+ * single embedding stores one number, older data one number per level
+ * @param {number | number[]} value
+ * @param {number} depth
+ */
+function coordinate(value: number | number[], depth: number): number {
+  return typeof value == "number" ? value : value[depth];
+}
+
 function clusterBounds(node: Node, depth: number): Rectangle {
-  const xs = node.leaves().map(leaf => leaf.data.x[depth]);
-  const ys = node.leaves().map(leaf => leaf.data.y[depth]);
+  const xs = node.leaves().map(leaf => coordinate(leaf.data.x, depth));
+  const ys = node.leaves().map(leaf => coordinate(leaf.data.y, depth));
   const left = Math.min(...xs);
   const top = Math.min(...ys);
   const width = Math.max(...xs) - left;
@@ -156,7 +166,10 @@ function clusterSpacing(node: Node): number {
   return minDist(
     node
       .leaves()
-      .map(leaf => [leaf.data.x[node.depth], leaf.data.y[node.depth]])
+      .map(leaf => [
+        coordinate(leaf.data.x, node.depth),
+        coordinate(leaf.data.y, node.depth)
+      ])
   );
 }
 
@@ -165,8 +178,8 @@ function nodeLocation(node: Node, depth: number): [number, number] {
 
   const i = Math.min(depth, node.depth);
 
-  const x = node.data.x[i];
-  const y = node.data.y[i];
+  const x = coordinate(node.data.x, i);
+  const y = coordinate(node.data.y, i);
   return [x, y];
 }
 
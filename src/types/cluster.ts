@@ -4,8 +4,8 @@ export interface ClusterData {
   name?: string;
   preview?: string;
   size?: number;
-  x?: number[];
-  y?: number[];
+  x?: number | number[];
+  y?: number | number[];
   children?: ClusterData[];
 }
 
@@ -14,8 +14,8 @@ export const ClusterData: t.Type<ClusterData> = t.recursion("ClusterData", () =>
     name: t.string,
     preview: t.string,
     size: t.number,
-    x: t.array(t.number),
-    y: t.array(t.number),
+    x: t.union([t.number, t.array(t.number)]),
+    y: t.union([t.number, t.array(t.number)]),
     children: t.array(ClusterData)
   })
 );